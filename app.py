@@ -10,7 +10,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # 导入协议定义
-from protocol import ContextPack, SearchSpec
+from protocol import ContextPack, SearchSpec, BatchOptimizeRequest
 
 app = Flask(__name__)
 
@@ -21,12 +21,8 @@ MODEL_NAME = 'qwen-plus'
 if not os.environ.get("DASHSCOPE_API_KEY") and not dashscope.api_key:
     print("⚠️ Warning: DASHSCOPE_API_KEY not found. Please set it in .env or environment variables.")
 
-def call_qwen_brain(context_md: str) -> str:
-    """
-    封装 DashScope API 调用逻辑
-    """
-    # --- [关键修改] 注入强 JSON 结构的 System Prompt ---
-    system_prompt = """
+# --- [关键修改] 注入强 JSON 结构的 System Prompt ---
+SYSTEM_PROMPT = """
     你是一个卫星热控系统的AI设计专家 (DV1.2 Brain)。
     你的任务是根据输入的物理设计现状 (ContextPack)，输出符合严格 Schema 定义的优化指令 (SearchSpec)。
 
@@ -55,10 +51,54 @@ def call_qwen_brain(context_md: str) -> str:
     4. 如果是 MOVE 操作，请只选择一个最有可能解决问题的轴向进行搜索，不要同时给出三个轴。
     """
 
+# --- 多设计打包 (Prompt Packing) ---
+# 一次请求携带多个 ContextPack，共享同一份 System Prompt，摊薄每次调用的固定开销
+BATCH_MAX_DESIGNS = 8          # 单次打包的最大设计数
+BATCH_MAX_PROMPT_CHARS = 12000 # 单次打包的 User Prompt 字符上限
+
+# 输出长度预算: 每份 SearchSpec 预留的 token 数，打包调用的 max_tokens 随设计数增长
+SPEC_OUTPUT_TOKENS = 800
+BATCH_OUTPUT_OVERHEAD_TOKENS = 200
+MODEL_MAX_OUTPUT_TOKENS = 8192 # qwen-plus 单次输出上限
+
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+    【批量模式】
+    本次输入包含多个相互独立的设计，每个设计以 "=== DESIGN <design_id> ===" 开头。
+    请对每个设计分别给出一份上述结构的 SearchSpec，并按如下结构输出纯 JSON (不要使用 Markdown 代码块):
+    {
+        "results": [
+            {"design_id": "与输入完全一致的设计ID", "spec": { ...单个 SearchSpec... }}
+        ]
+    }
+    每个 design_id 必须且只能出现一次，不要混用不同设计的信息。
+    """
+
+
+class ModelInferenceError(Exception):
+    """API 层失败 (限流/超时/鉴权等)，重试只会放大请求数"""
+
+class OutputTruncatedError(Exception):
+    """模型输出因 max_tokens 被截断 (finish_reason == "length")"""
+
+
+def batch_max_tokens(n_designs: int) -> int:
+    """打包调用的输出 token 上限，随设计数线性增长"""
+    return min(MODEL_MAX_OUTPUT_TOKENS, BATCH_OUTPUT_OVERHEAD_TOKENS + SPEC_OUTPUT_TOKENS * n_designs)
+
+def max_designs_per_chunk() -> int:
+    """单次打包的设计数，同时受 BATCH_MAX_DESIGNS 与输出长度预算约束"""
+    by_output = (MODEL_MAX_OUTPUT_TOKENS - BATCH_OUTPUT_OVERHEAD_TOKENS) // SPEC_OUTPUT_TOKENS
+    return max(1, min(BATCH_MAX_DESIGNS, by_output))
+
+def _call_qwen(system_prompt: str, user_content: str, max_tokens=None) -> str:
+    """
+    封装 DashScope API 调用逻辑
+    """
     messages = [
         {'role': Role.SYSTEM, 'content': system_prompt},
-        {'role': Role.USER, 'content': f"当前设计状态如下：\n{context_md}"}
+        {'role': Role.USER, 'content': user_content}
     ]
+    params = {'max_tokens': max_tokens} if max_tokens else {}
 
     try:
         response = dashscope.Generation.call(
@@ -66,15 +106,111 @@ def call_qwen_brain(context_md: str) -> str:
             messages=messages,
             result_format='message',
             temperature=0.5, # 降低温度，让结构更稳定
+            **params,
         )
+    except Exception as e:
+        raise ModelInferenceError(f"Model Inference Failed: {str(e)}")
 
-        if response.status_code == 200:
-            return response.output.choices[0].message.content
-        else:
-            raise Exception(f"Qwen API Error: {response.code} - {response.message}")
+    if response.status_code != 200:
+        raise ModelInferenceError(f"Model Inference Failed: Qwen API Error: {response.code} - {response.message}")
 
-    except Exception as e:
-        raise Exception(f"Model Inference Failed: {str(e)}")
+    choice = response.output.choices[0]
+    if choice.finish_reason == "length":
+        raise OutputTruncatedError(f"Output truncated at max_tokens={max_tokens}")
+    return choice.message.content
+
+def call_qwen_brain(context_md: str) -> str:
+    """单设计调用"""
+    return _call_qwen(SYSTEM_PROMPT, f"当前设计状态如下：\n{context_md}")
+
+def build_packed_prompt(blocks) -> str:
+    """拼接打包后的 User Prompt (字符上限按该字符串整体计算)"""
+    return "当前待优化的设计如下：\n" + "\n".join(blocks)
+
+def call_qwen_brain_batch(packed_prompt: str, n_designs: int) -> str:
+    """多设计打包调用"""
+    return _call_qwen(BATCH_SYSTEM_PROMPT, packed_prompt, max_tokens=batch_max_tokens(n_designs))
+
+def clean_llm_json(raw: str) -> str:
+    """清洗数据 (处理可能存在的 Markdown 标记)"""
+    clean_json_str = raw.strip()
+    if clean_json_str.startswith("```json"):
+        clean_json_str = clean_json_str[7:]
+    if clean_json_str.endswith("```"):
+        clean_json_str = clean_json_str[:-3]
+    return clean_json_str.strip()
+
+def pack_designs(design_mds):
+    """
+    按数量与字符上限把 [(design_id, context_md), ...] 切分成若干批次。
+    返回 (batches, oversized)：batches 中每个批次为 [(design_id, block), ...]；
+    单个设计就已超过上限的 design_id 放入 oversized，直接走单独调用。
+    """
+    batches, current, oversized = [], [], []
+    for design_id, md in design_mds:
+        block = f"=== DESIGN {design_id} ===\n{md}\n"
+        if len(build_packed_prompt([block])) > BATCH_MAX_PROMPT_CHARS:
+            oversized.append(design_id)
+            continue
+        candidate = [b for _, b in current] + [block]
+        if current and (len(current) >= max_designs_per_chunk() or len(build_packed_prompt(candidate)) > BATCH_MAX_PROMPT_CHARS):
+            batches.append(current)
+            current = []
+        current.append((design_id, block))
+    if current:
+        batches.append(current)
+    return batches, oversized
+
+def split_batch_response(raw: str, design_ids):
+    """
+    将打包响应拆回 {design_id: SearchSpec}，逐个校验。
+    缺失、重复或校验失败的设计不出现在返回值中，由调用方回退到单独调用。
+    """
+    try:
+        payload = json.loads(clean_llm_json(raw))
+        items = payload["results"]
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        print(f"❌ Malformed batch response: {e}")
+        return {}
+
+    wanted = set(design_ids)
+    seen, specs = set(), {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        design_id = item.get("design_id")
+        if not isinstance(design_id, str) or design_id not in wanted:
+            continue
+        if design_id in seen:
+            # 同一设计出现多次，无法判断哪份可信，整体回退
+            specs.pop(design_id, None)
+            continue
+        seen.add(design_id)
+        try:
+            specs[design_id] = SearchSpec(**item["spec"])
+        except (ValidationError, KeyError, TypeError) as e:
+            print(f"❌ Protocol Violation in batch ({design_id}): {e}")
+    return specs
+
+def optimize_single(context_md: str) -> SearchSpec:
+    """单设计完整流程: 调用 -> 清洗 -> 校验"""
+    llm_raw_output = call_qwen_brain(context_md)
+    return SearchSpec(**json.loads(clean_llm_json(llm_raw_output)))
+
+def optimize_single_safe(context_md: str) -> dict:
+    """
+    单设计调用，输出层面的失败转为可序列化的错误描述。
+    ModelInferenceError 继续上抛，由调用方停止后续调用。
+    """
+    try:
+        return optimize_single(context_md).model_dump()
+    except ValidationError as ve:
+        # include_context=False: field_validator 抛出的 ValueError 无法 JSON 序列化
+        return {"error": "Protocol Violation", "details": ve.errors(include_context=False)}
+    except json.JSONDecodeError:
+        return {"error": "Invalid JSON from LLM"}
+    except OutputTruncatedError as e:
+        return {"error": "Output Truncated", "message": str(e)}
 
 @app.route('/optimize', methods=['POST'])
 def optimize_design():
@@ -92,13 +228,7 @@ def optimize_design():
         print(f"--- [Log] Qwen Response (Raw) ---\n{llm_raw_output}")
 
         # Step 4: 清洗数据 (处理可能存在的 Markdown 标记)
-        clean_json_str = llm_raw_output.strip()
-        if clean_json_str.startswith("```json"):
-            clean_json_str = clean_json_str[7:]
-        if clean_json_str.endswith("```"):
-            clean_json_str = clean_json_str[:-3]
-        
-        spec_dict = json.loads(clean_json_str.strip())
+        spec_dict = json.loads(clean_llm_json(llm_raw_output))
 
         # Step 5: Pydantic 强校验
         validated_spec = SearchSpec(**spec_dict)
@@ -117,6 +247,71 @@ def optimize_design():
         print(f"❌ Server Error: {e}")
         return jsonify({"error": "Internal Server Error", "message": str(e)}), 500
 
+@app.route('/optimize_batch', methods=['POST'])
+def optimize_batch():
+    """
+    多设计打包接口: 一次调用处理多个 ContextPack。
+    输入: {"designs": [{"design_id": "...", "context": {...ContextPack}}, ...]}
+    输出: {"results": {design_id: SearchSpec | {"error": ...}}, "stats": {...}}
+    """
+    try:
+        # silent=True: 非 JSON / 非对象请求体统一落到 ValidationError -> 400
+        batch = BatchOptimizeRequest.model_validate(request.get_json(silent=True))
+    except ValidationError as ve:
+        print(f"❌ Protocol Violation: {ve}")
+        return jsonify({"error": "Protocol Violation", "details": ve.errors(include_context=False)}), 400
+
+    design_mds = [(d.design_id, d.context.to_markdown_prompt()) for d in batch.designs]
+    md_by_id = dict(design_mds)
+    batches, oversized = pack_designs(design_mds)
+    results, fallback_ids = {}, []
+    stats = {"designs": len(design_mds), "packed_calls": 0, "truncated_calls": 0,
+             "fallback_calls": 0, "single_calls": 0}
+
+    # Step 1: 打包调用
+    for chunk in batches:
+        chunk_ids = [design_id for design_id, _ in chunk]
+        print(f"--- [Log] Sending batch of {len(chunk_ids)} to {MODEL_NAME}: {chunk_ids} ---")
+        stats["packed_calls"] += 1
+        try:
+            llm_raw_output = call_qwen_brain_batch(build_packed_prompt([block for _, block in chunk]), len(chunk))
+        except OutputTruncatedError as e:
+            # 输出被截断，单独统计以便诊断 fallback_calls 偏高的原因
+            print(f"⚠️ Batch output truncated ({len(chunk_ids)} designs): {e}")
+            stats["truncated_calls"] += 1
+            fallback_ids.extend(chunk_ids)
+            continue
+        except ModelInferenceError as e:
+            # API 层失败 (限流/超时/鉴权) 不回退单独调用，否则会在限流下放大请求数
+            print(f"❌ Batch call failed: {e}")
+            for design_id in chunk_ids:
+                results[design_id] = {"error": "Model Inference Failed", "message": str(e)}
+            continue
+
+        # 仅当打包响应异常 (格式错误/缺失/校验失败) 时回退
+        specs = split_batch_response(llm_raw_output, chunk_ids)
+        for design_id in chunk_ids:
+            if design_id in specs:
+                results[design_id] = specs[design_id].model_dump()
+            else:
+                fallback_ids.append(design_id)
+
+    # Step 2: 打包响应异常的设计回退单独调用，单独超过字符上限的设计直接单独调用
+    # 遇到 API 层失败即停止，剩余设计标记失败，避免在限流下继续放大请求数
+    single_queue = [(d, "fallback_calls") for d in fallback_ids] + [(d, "single_calls") for d in oversized]
+    for i, (design_id, counter) in enumerate(single_queue):
+        print(f"--- [Log] Single call ({counter}): {design_id} ---")
+        stats[counter] += 1
+        try:
+            results[design_id] = optimize_single_safe(md_by_id[design_id])
+        except ModelInferenceError as e:
+            print(f"❌ Single call failed, skipping remaining {len(single_queue) - i - 1}: {e}")
+            for rest_id, _ in single_queue[i:]:
+                results[rest_id] = {"error": "Model Inference Failed", "message": str(e)}
+            break
+
+    return jsonify({"results": results, "stats": stats}), 200
+
 if __name__ == '__main__':
     print(f"🚀 Satellite Semantic Engine (powered by {MODEL_NAME}) is running on port 5000...")
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -202,4 +202,27 @@ class ContextPack(BaseModel):
         md += f"\n## 4. Constraint Rules\nAllowed Operators: {', '.join(self.allowed_ops)}\n"
         if self.history_trace:
             md += "\n## 5. History Trace\n" + "\n".join([f"- {h}" for h in self.history_trace])
-        return md
\ No newline at end of file
+        return md
+
+# --- Batch: 多设计打包 (Prompt Packing) ---
+# 单次 HTTP 请求的设计数上限，避免一个请求串行执行过多 LLM 调用导致客户端超时
+MAX_BATCH_REQUEST_DESIGNS = 32
+
+class DesignContext(BaseModel):
+    """
+    批量请求中的单个设计，design_id 用于把打包响应拆回到对应设计。
+    """
+    # 该 ID 直接写入打包 Prompt 的分隔行，限制字符集防止伪造分隔符
+    design_id: str = Field(..., min_length=1, pattern=r"^[A-Za-z0-9_.\-]{1,64}$",
+                           description="设计唯一ID，例如 'CAMPAIGN_A_LOOP_017'")
+    context: ContextPack
+
+class BatchOptimizeRequest(BaseModel):
+    designs: List[DesignContext] = Field(..., min_length=1, max_length=MAX_BATCH_REQUEST_DESIGNS)
+
+    @field_validator('designs')
+    def check_unique_ids(cls, v):
+        ids = [d.design_id for d in v]
+        if len(ids) != len(set(ids)):
+            raise ValueError(f"Duplicate design_id in batch: {ids}")
+        return v
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 项目模块位于仓库根目录 (app.py / protocol.py)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,217 @@
+import json
+
+import pytest
+
+import app as brain
+from protocol import MAX_BATCH_REQUEST_DESIGNS
+
+
+def make_context(iteration=1, geometry="Battery at (8, 0, 18)."):
+    return {
+        "design_iteration": iteration,
+        "metrics": {"max_temp": 60.0, "min_dist": 2.0},
+        "violations": [],
+        "geometry_summary": geometry,
+        "thermal_summary": "Max Temp 60.0C.",
+        "history_trace": [],
+    }
+
+
+def make_spec(plan_id="PLAN_001", bounds=(-5.0, 0.0)):
+    return {
+        "plan_id": plan_id,
+        "reasoning_summary": "Move away from rib",
+        "actions": [{"op_id": "MOVE", "target_component": "Battery",
+                     "search_axis": "X", "bounds": list(bounds)}],
+    }
+
+
+def batch_reply(*items):
+    return json.dumps({"results": [{"design_id": d, "spec": s} for d, s in items]})
+
+
+@pytest.fixture
+def client():
+    brain.app.config["TESTING"] = True
+    return brain.app.test_client()
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """记录 LLM 调用次数，默认单独调用返回合法 SearchSpec"""
+    record = {"batch": [], "single": []}
+
+    def fake_single(context_md):
+        record["single"].append(context_md)
+        return json.dumps(make_spec("PLAN_SINGLE"))
+
+    monkeypatch.setattr(brain, "call_qwen_brain", fake_single)
+    return record
+
+
+def set_batch_reply(monkeypatch, calls, reply):
+    def fake_batch(packed_prompt, n_designs):
+        calls["batch"].append(packed_prompt)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply(packed_prompt) if callable(reply) else reply
+    monkeypatch.setattr(brain, "call_qwen_brain_batch", fake_batch)
+
+
+# --- split_batch_response ---
+
+def test_split_returns_each_design():
+    raw = batch_reply(("D1", make_spec("P1")), ("D2", make_spec("P2")))
+    specs = brain.split_batch_response(raw, ["D1", "D2"])
+    assert {k: v.plan_id for k, v in specs.items()} == {"D1": "P1", "D2": "P2"}
+
+
+def test_split_strips_markdown_fence():
+    raw = "```json\n" + batch_reply(("D1", make_spec())) + "\n```"
+    assert set(brain.split_batch_response(raw, ["D1"])) == {"D1"}
+
+
+def test_split_drops_duplicate_missing_and_invalid():
+    raw = batch_reply(
+        ("D1", make_spec("P1")), ("D1", make_spec("P1b")),   # 重复
+        ("D2", make_spec(bounds=(5.0, 1.0))),                # 校验失败
+        ("D4", make_spec("P4")),
+        ("UNKNOWN", make_spec()),                            # 未请求
+    )
+    specs = brain.split_batch_response(raw, ["D1", "D2", "D3", "D4"])  # D3 缺失
+    assert set(specs) == {"D4"}
+
+
+def test_split_ignores_unhashable_design_id():
+    raw = json.dumps({"results": [
+        {"design_id": ["D1"], "spec": make_spec()},
+        {"design_id": "D2", "spec": make_spec("P2")},
+    ]})
+    assert set(brain.split_batch_response(raw, ["D1", "D2"])) == {"D2"}
+
+
+@pytest.mark.parametrize("raw", ["not json", json.dumps({"foo": []}), json.dumps([1, 2])])
+def test_split_malformed_returns_empty(raw):
+    assert brain.split_batch_response(raw, ["D1"]) == {}
+
+
+# --- pack_designs ---
+
+def test_pack_respects_design_count(monkeypatch):
+    monkeypatch.setattr(brain, "BATCH_MAX_DESIGNS", 3)
+    batches, oversized = brain.pack_designs([(f"D{i}", "x") for i in range(7)])
+    assert [len(b) for b in batches] == [3, 3, 1]
+    assert oversized == []
+
+
+def test_pack_respects_final_prompt_size(monkeypatch):
+    monkeypatch.setattr(brain, "BATCH_MAX_PROMPT_CHARS", 300)
+    batches, oversized = brain.pack_designs([(f"D{i}", "x" * 80) for i in range(6)])
+    assert oversized == []
+    assert len(batches) > 1
+    for chunk in batches:
+        assert len(brain.build_packed_prompt([b for _, b in chunk])) <= 300
+
+
+def test_pack_sends_oversized_design_alone(monkeypatch):
+    monkeypatch.setattr(brain, "BATCH_MAX_PROMPT_CHARS", 200)
+    batches, oversized = brain.pack_designs([("D1", "x"), ("BIG", "y" * 500), ("D2", "x")])
+    assert oversized == ["BIG"]
+    assert [[d for d, _ in b] for b in batches] == [["D1", "D2"]]
+
+
+# --- /optimize_batch ---
+
+def post_batch(client, ids):
+    body = {"designs": [{"design_id": d, "context": make_context()} for d in ids]}
+    return client.post("/optimize_batch", json=body)
+
+
+def test_endpoint_packs_into_one_call(client, monkeypatch, calls):
+    set_batch_reply(monkeypatch, calls, batch_reply(("D1", make_spec("P1")), ("D2", make_spec("P2"))))
+    resp = post_batch(client, ["D1", "D2"])
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data["results"]["D1"]["plan_id"] == "P1"
+    assert data["results"]["D2"]["plan_id"] == "P2"
+    assert len(calls["batch"]) == 1 and calls["single"] == []
+
+
+def test_endpoint_falls_back_for_missing_design(client, monkeypatch, calls):
+    set_batch_reply(monkeypatch, calls, batch_reply(("D1", make_spec("P1"))))
+    data = post_batch(client, ["D1", "D2"]).get_json()
+    assert data["results"]["D1"]["plan_id"] == "P1"
+    assert data["results"]["D2"]["plan_id"] == "PLAN_SINGLE"
+    assert data["stats"]["fallback_calls"] == 1
+
+
+def test_endpoint_invalid_fallback_stays_per_design(client, monkeypatch, calls):
+    set_batch_reply(monkeypatch, calls, batch_reply(("D1", make_spec("P1"))))
+    monkeypatch.setattr(brain, "call_qwen_brain", lambda md: json.dumps(make_spec(bounds=(5.0, 1.0))))
+    resp = post_batch(client, ["D1", "D2"])
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data["results"]["D1"]["plan_id"] == "P1"
+    assert data["results"]["D2"]["error"] == "Protocol Violation"
+
+
+def test_endpoint_api_error_does_not_fall_back(client, monkeypatch, calls):
+    set_batch_reply(monkeypatch, calls, brain.ModelInferenceError("Qwen API Error: 429 - Throttling"))
+    data = post_batch(client, [f"D{i}" for i in range(8)]).get_json()
+    assert len(calls["batch"]) == 1 and calls["single"] == []
+    assert all(r["error"] == "Model Inference Failed" for r in data["results"].values())
+
+
+def test_endpoint_rejects_duplicate_design_id(client, calls):
+    resp = post_batch(client, ["D1", "D1"])
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == "Protocol Violation"
+
+
+def test_endpoint_rejects_too_many_designs(client, calls):
+    resp = post_batch(client, [f"D{i}" for i in range(MAX_BATCH_REQUEST_DESIGNS + 1)])
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize("design_id", ["", "A ===\n=== DESIGN B", "has space", "x" * 65])
+def test_endpoint_rejects_malformed_design_id(client, calls, design_id):
+    resp = post_batch(client, [design_id])
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == "Protocol Violation"
+
+
+def test_endpoint_rejects_non_object_body(client, calls):
+    assert client.post("/optimize_batch", json=[1, 2]).status_code == 400
+    assert client.post("/optimize_batch", data="designs", content_type="text/plain").status_code == 400
+
+
+def test_endpoint_stops_fallback_on_api_error(client, monkeypatch, calls):
+    set_batch_reply(monkeypatch, calls, "not json")
+
+    def throttled(context_md):
+        calls["single"].append(context_md)
+        raise brain.ModelInferenceError("Qwen API Error: 429 - Throttling")
+
+    monkeypatch.setattr(brain, "call_qwen_brain", throttled)
+    data = post_batch(client, [f"D{i}" for i in range(5)]).get_json()
+    assert len(calls["single"]) == 1
+    assert all(r["error"] == "Model Inference Failed" for r in data["results"].values())
+
+
+def test_endpoint_truncated_batch_is_counted(client, monkeypatch, calls):
+    set_batch_reply(monkeypatch, calls, brain.OutputTruncatedError("Output truncated"))
+    data = post_batch(client, ["D1", "D2"]).get_json()
+    assert data["stats"]["truncated_calls"] == 1
+    assert data["stats"]["fallback_calls"] == 2
+    assert data["results"]["D1"]["plan_id"] == "PLAN_SINGLE"
+
+
+def test_batch_max_tokens_scales_with_chunk():
+    assert brain.batch_max_tokens(1) < brain.batch_max_tokens(4) <= brain.MODEL_MAX_OUTPUT_TOKENS
+    assert brain.batch_max_tokens(brain.max_designs_per_chunk()) <= brain.MODEL_MAX_OUTPUT_TOKENS
+
+
+def test_pack_caps_chunk_by_output_budget(monkeypatch):
+    monkeypatch.setattr(brain, "SPEC_OUTPUT_TOKENS", 3000)
+    batches, _ = brain.pack_designs([(f"D{i}", "x") for i in range(5)])
+    assert max(len(b) for b in batches) == brain.max_designs_per_chunk() == 2